@@ -1,18 +1,15 @@
 import os
 import io
+import re
+import hashlib
 import time
+import threading
+from collections import OrderedDict, deque
+from itertools import islice
 import streamlit as st
-from docx import Document
-from reportlab.platypus import SimpleDocTemplate, Paragraph
-from reportlab.lib.styles import getSampleStyleSheet
-import PyPDF2
 
-# NOTE: if you're using OpenAI's new Python package, adjust imports.
-# This code expects: from openai import OpenAI and client.chat.completions.create
-try:
-    from openai import OpenAI
-except Exception:
-    OpenAI = None
+# NOTE: docx, reportlab, PyPDF2/PyMuPDF and openai are imported where they are used,
+# so a session that never uploads, downloads or calls the API doesn't pay for them.
 
 # -------------------------
 # Configuration
@@ -21,16 +18,56 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 MODEL_NAME = "gpt-4o-mini"  # change if needed / available
 INITIAL_CREDITS = 100.0
 COST_PER_REPORT = 1.0  # mock credit cost
+LLM_MAX_ATTEMPTS = 3  # tries per LLM request on rate-limit/connection errors
+LLM_RETRY_BACKOFF = 0.5  # seconds before the first retry, doubled after each
+LLM_TIMEOUT = 60.0  # seconds per API request (SDK default is 600)
+REPORT_CACHE_TTL = 3600  # seconds a generated report is reused for identical inputs
+REPORT_CACHE_MAX = 256  # generated reports kept in the process-wide cache
+EXPORT_CACHE_MAX = 32  # rendered DOCX/PDF files kept per format
+PARSE_CACHE_MAX = 32  # parsed uploads kept across all sessions
+EMBEDDING_MODEL = "all-MiniLM-L6-v2"  # sentence-transformers model for the semantic cache (optional)
+SEMANTIC_CACHE_THRESHOLD = 0.95  # min cosine similarity to reuse a report for a reworded question
+# words ignored when checking that a reworded question asks about the same things
+SEMANTIC_STOP_WORDS = frozenset((
+    "a", "an", "the", "of", "in", "on", "for", "to", "and", "with", "what", "is", "are", "me", "please",
+))
+SEMANTIC_CACHE_MAX = 100  # question embeddings kept per session
+STREAM_MIN_CHARS = 32  # batch streamed tokens into chunks of at least this size
+LIVE_FEED_MAX = 200  # newest live updates kept in session state
+BILLING_LOG_MAX = 500  # newest billing records kept in session state
+LIVE_ENTRY_MAX_CHARS = 4096  # per-entry live content sent to the LLM
+TEXT_FILE_MAX_BYTES = 5 * 1024 * 1024  # bytes read from an uploaded text file
+FILE_TEXT_MAX_TOKENS = 60000  # token budget for uploaded file content in the prompt
+
+# Report post-processing: markdown section headers, a plain "Sources:" line, and bullet lines
+_SECTION_RE = re.compile(r"(?m)^\s*#{1,3}\s*([^\n]+?)\s*$")
+_SOURCES_RE = re.compile(r"(?mi)^\s*(?:#{1,3}\s*)?Sources:?\s*$(.*)", re.S)
+_BULLET_RE = re.compile(r"^\s*([\[\-\u2022].*)$", re.M)
+_WORD_RE = re.compile(r"[a-z0-9]+")
+# Key Takeaways under any heading style ("**Key Takeaways:**", "## 1. Key Takeaways (bulleted)"):
+# the heading line plus the run of bullet/blank lines after it
+_TAKEAWAYS_RE = re.compile(r"(?im)^[^\n]*Key Takeaways[^\n]*\n((?:[ \t]*(?:[\-\u2022][^\n]*)?(?:\n|\Z))*)")
+_TAKEAWAY_BULLET_RE = re.compile(r"^\s*([\-\u2022].*)$", re.M)
 
 # -------------------------
 # Initialize OpenAI client (or run mock)
 # -------------------------
-client = None
-if OPENAI_API_KEY and OpenAI is not None:
+# NOTE: if you're using OpenAI's new Python package, adjust imports.
+# This code expects: from openai import OpenAI and client.chat.completions.create
+@st.cache_resource(show_spinner=False)
+def get_client():
+    """
+    Build the OpenAI client once per process and share it (and its connection pool)
+    across sessions and reruns. Returns None (mock mode) if no key or no openai package.
+    """
+    if not OPENAI_API_KEY:
+        return None
     try:
-        client = OpenAI(api_key=OPENAI_API_KEY)
+        from openai import OpenAI
+        # retries are handled by _create_completion; SDK retries on top would multiply them
+        return OpenAI(api_key=OPENAI_API_KEY, max_retries=0, timeout=LLM_TIMEOUT)
     except Exception:
-        client = None
+        return None
 
 # -------------------------
 # Streamlit page config
@@ -53,10 +90,16 @@ if "credits_used" not in st.session_state:
 if "credits_remaining" not in st.session_state:
     st.session_state.credits_remaining = float(INITIAL_CREDITS)
 if "billing_log" not in st.session_state:
-    st.session_state.billing_log = []  # list of dicts: {q, cost, ts}
+    st.session_state.billing_log = deque(maxlen=BILLING_LOG_MAX)  # dicts: {q, cost, ts}
 if "live_feed" not in st.session_state:
     # mock live feed: each entry is dict {id, title, source, content, ts}
-    st.session_state.live_feed = []
+    st.session_state.live_feed = deque(maxlen=LIVE_FEED_MAX)
+if "sem_cache" not in st.session_state:
+    # semantic report cache: each entry is dict {file_hash, live_hash, question, terms, vec, report}
+    st.session_state.sem_cache = deque(maxlen=SEMANTIC_CACHE_MAX)
+if "file_context" not in st.session_state:
+    # extracted, truncated and hashed upload text: dict {key, text, sources, hash, skipped}
+    st.session_state.file_context = None
 if "sources" not in st.session_state:
     st.session_state.sources = []  # list of strings
 if "last_report" not in st.session_state:
@@ -65,77 +108,158 @@ if "last_report" not in st.session_state:
 # -------------------------
 # Helpers: file extraction & downloads
 # -------------------------
-def save_to_docx(report_text, title="research_report"):
+# save_to_docx / save_to_pdf return bytes and are cached on (report_text, title),
+# so reruns serve the same download data without re-rendering.
+@st.cache_data(show_spinner=False, max_entries=EXPORT_CACHE_MAX, ttl=REPORT_CACHE_TTL)
+def save_to_docx(report_text: str, title: str = "research_report") -> bytes:
+    from docx import Document
     doc = Document()
     # add title
     doc.add_heading(title, level=1)
-    for line in report_text.split("\n"):
-        doc.add_paragraph(line)
+    # one paragraph per blank-line-separated block, soft line breaks within it
+    for block in report_text.split("\n\n"):
+        lines = block.split("\n")
+        p = doc.add_paragraph()
+        p.add_run(lines[0])
+        for ln in lines[1:]:
+            run = p.add_run()
+            run.add_break()
+            run.add_text(ln)
     buffer = io.BytesIO()
     doc.save(buffer)
-    buffer.seek(0)
-    return buffer
+    return buffer.getvalue()
+
+@st.cache_resource(show_spinner=False)
+def _pdf_styles():
+    """reportlab's sample stylesheet, built once per process (read-only; don't mutate)."""
+    from reportlab.lib.styles import getSampleStyleSheet
+    return getSampleStyleSheet()
 
-def save_to_pdf(report_text, title="research_report"):
+@st.cache_data(show_spinner=False, max_entries=EXPORT_CACHE_MAX, ttl=REPORT_CACHE_TTL)
+def save_to_pdf(report_text: str, title: str = "research_report") -> bytes:
+    from reportlab.platypus import SimpleDocTemplate, Paragraph
     buffer = io.BytesIO()
     doc = SimpleDocTemplate(buffer)
-    styles = getSampleStyleSheet()
+    styles = _pdf_styles()
     story = [Paragraph(f"<b>{title}</b>", styles["Heading1"])]
     # split into paragraphs
     for paragraph in report_text.split("\n\n"):
         story.append(Paragraph(paragraph.replace("\n", "<br/>"), styles["Normal"]))
     doc.build(story)
-    buffer.seek(0)
-    return buffer
+    return buffer.getvalue()
+
+def _pdf_text(data):
+    """Extract text from PDF bytes, preferring PyMuPDF and falling back to PyPDF2."""
+    try:
+        import fitz  # PyMuPDF: text extraction in C; PyPDF2 stays as a fallback
+        pdf = fitz.open(stream=data, filetype="pdf")
+        try:
+            return "\n".join(page.get_text("text") for page in pdf)
+        finally:
+            pdf.close()
+    except Exception:
+        import PyPDF2
+        reader = PyPDF2.PdfReader(io.BytesIO(data))
+        # write pages straight into one buffer instead of collecting a list of page strings
+        buf = io.StringIO()
+        for p in reader.pages:
+            buf.write(p.extract_text() or "")
+            buf.write("\n")
+        return buf.getvalue()
+
+def _file_kind(name: str, mime: str):
+    """Classify an upload as "pdf", "docx" or "text" (txt and unknown types are read as text)."""
+    if name.lower().endswith(".pdf") or mime == "application/pdf":
+        return "pdf"
+    if name.lower().endswith(".docx") or mime in (
+        "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    ):
+        return "docx"
+    return "text"
+
+@st.cache_data(show_spinner=False, max_entries=PARSE_CACHE_MAX, ttl=REPORT_CACHE_TTL)
+def _parse_one_cached(name: str, kind: str, data: bytes):
+    """
+    Extract text from one uploaded file's bytes. Returns (piece, source).
+    Cached on the file content so Streamlit reruns don't re-parse unchanged uploads.
+    """
+    try:
+        if kind == "pdf":
+            file_text = _pdf_text(data)
+            return f"[File: {name}]\n{file_text}\n", f"{name}"
+        elif kind == "docx":
+            from docx import Document
+            doc = Document(io.BytesIO(data))
+            file_text = "\n".join(p.text for p in doc.paragraphs if p.text)
+            return f"[File: {name}]\n{file_text}\n", f"{name}"
+        else:
+            # .txt, text/plain, and fallback for anything else: read as text
+            raw = data.decode("utf-8", errors="ignore")
+            return f"[File: {name}]\n{raw}\n", f"{name}"
+    except Exception as e:
+        return f"[File: {name}] (error reading file: {e})\n", f"{name} (read error)"
+
+def _extract_one(f):
+    """Extract text from a single uploaded file. Returns (piece, source)."""
+    name = getattr(f, "name", "uploaded_file")
+    kind = _file_kind(name, getattr(f, "type", ""))
+    try:
+        if hasattr(f, "seek"):
+            f.seek(0)
+        # text goes straight into the prompt, so only read up to the cap
+        data = f.read(TEXT_FILE_MAX_BYTES) if kind == "text" else f.read()
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+    except Exception as e:
+        return f"[File: {name}] (error reading file: {e})\n", f"{name} (read error)"
+    return _parse_one_cached(name, kind, data)
 
 def extract_file_content(uploaded_files):
-    """Extract text from uploaded file-like Streamlit files (pdf/docx/txt)."""
-    pieces = []
-    file_sources = []
+    """Extract text from uploaded file-like Streamlit files (pdf/docx/txt). Returns [(piece, source)] in upload order."""
+    # parse serially: PyMuPDF isn't thread-safe and python-docx holds the GIL,
+    # so a thread pool gains nothing and can crash on concurrent PDFs
+    return [_extract_one(f) for f in uploaded_files or []]
+
+def _truncate_to_tokens(text: str, max_tokens: int):
+    """Cut text to max_tokens model tokens (tiktoken if installed, else ~4 chars per token)."""
+    if len(text.encode("utf-8")) <= max_tokens:
+        return text  # every token covers at least one byte, so it already fits
+    try:
+        import tiktoken
+    except ImportError:
+        return text[:max_tokens * 4]
+    try:
+        enc = tiktoken.encoding_for_model(MODEL_NAME)
+    except KeyError:
+        enc = tiktoken.get_encoding("o200k_base")
+    ids = enc.encode(text, disallowed_special=())
+    return text if len(ids) <= max_tokens else enc.decode(ids[:max_tokens])
+
+def prepare_file_context(uploaded_files):
+    """
+    Extract, truncate and hash the uploaded files once per upload set.
+    Returns (file_text, file_sources, file_hash, skipped); reused from session state while the
+    uploads are unchanged. Files cut off entirely by the token budget are left out of
+    file_sources and listed in skipped, so no citation names content the model never saw.
+    """
     if not uploaded_files:
-        return "", []
-    for f in uploaded_files:
-        name = getattr(f, "name", "uploaded_file")
-        mime = getattr(f, "type", "")
-        try:
-            if name.lower().endswith(".pdf") or mime == "application/pdf":
-                reader = PyPDF2.PdfReader(f)
-                text = []
-                for p in reader.pages:
-                    page_text = p.extract_text() or ""
-                    text.append(page_text)
-                file_text = "\n".join(text)
-                pieces.append(f"[File: {name}]\n{file_text}\n")
-                file_sources.append(f"{name}")
-            elif name.lower().endswith(".docx") or mime in (
-                "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-            ):
-                doc = Document(f)
-                text = []
-                for para in doc.paragraphs:
-                    if para.text:
-                        text.append(para.text)
-                file_text = "\n".join(text)
-                pieces.append(f"[File: {name}]\n{file_text}\n")
-                file_sources.append(f"{name}")
-            elif name.lower().endswith(".txt") or mime == "text/plain":
-                raw = f.read()
-                if isinstance(raw, bytes):
-                    raw = raw.decode("utf-8", errors="ignore")
-                pieces.append(f"[File: {name}]\n{raw}\n")
-                file_sources.append(f"{name}")
-            else:
-                # fallback: try to read as text
-                raw = f.read()
-                if isinstance(raw, bytes):
-                    raw = raw.decode("utf-8", errors="ignore")
-                pieces.append(f"[File: {name}]\n{raw}\n")
-                file_sources.append(f"{name}")
-        except Exception as e:
-            pieces.append(f"[File: {name}] (error reading file: {e})\n")
-            file_sources.append(f"{name} (read error)")
-    combined = "\n\n".join(pieces)
-    return combined, file_sources
+        return "", [], _text_hash(""), []
+    key = tuple((getattr(f, "file_id", None) or getattr(f, "name", ""), getattr(f, "size", None)) for f in uploaded_files)
+    ctx = st.session_state.file_context
+    if ctx and ctx["key"] == key:
+        return ctx["text"], ctx["sources"], ctx["hash"], ctx["skipped"]
+    results = extract_file_content(uploaded_files)
+    file_text = _truncate_to_tokens("\n\n".join(piece for piece, _ in results), FILE_TEXT_MAX_TOKENS)
+    file_sources, skipped = [], []
+    start = 0
+    for piece, source in results:
+        (file_sources if start < len(file_text) else skipped).append(source)
+        start += len(piece) + 2  # pieces are joined with "\n\n"
+    file_hash = _text_hash(file_text)
+    st.session_state.file_context = {
+        "key": key, "text": file_text, "sources": file_sources, "hash": file_hash, "skipped": skipped
+    }
+    return file_text, file_sources, file_hash, skipped
 
 # -------------------------
 # Mock Pathway Live Ingestion
@@ -149,26 +273,43 @@ def ingest_live_update(title: str, source: str, content: str):
         "content": content,
         "ts": time.strftime("%Y-%m-%d %H:%M:%S"),
     }
-    st.session_state.live_feed.insert(0, entry)  # newest first
-
-
+    st.session_state.live_feed.appendleft(entry)  # newest first; oldest drops off at LIVE_FEED_MAX
+
+
+def _live_feed_text(feed):
+    """Combine live feed entries into one prompt string, truncating each entry's content."""
+    parts = []
+    append = parts.append
+    for e in feed:
+        append(e["title"])
+        append(" (")
+        append(e["source"])
+        append("):\n")
+        append(e["content"][:LIVE_ENTRY_MAX_CHARS])
+        append("\n\n")
+    if parts:
+        parts.pop()  # no separator after the last entry
+    return "".join(parts)
 
 # -------------------------
 # LLM -> report generation
 # -------------------------
-def call_llm_generate(question: str, file_text: str, live_text: str):
-    """
-    Call the LLM to generate a structured report.
-    Returns full text (string).
-    If client not configured, returns a mock report.
-    """
+def _report_messages(question: str, file_text: str, live_text: str):
+    """Build the chat messages for report generation."""
+    # Static content first, dynamic content last: server-side prompt caching
+    # only reuses identical prefixes, so the question and context go at the end.
     system_prompt = (
         "You are an expert research assistant. Generate a structured, evidence-based research report "
         "that contains: Key Takeaways (bulleted), Abstract, Introduction, Main Sections depending on the question, "
         "Conclusion, and References. Inline-cite sources using [1], [2] etc. At the end include a 'Sources' section "
         "that maps citation numbers to source names/URLs/pages.\n\n"
         "If provided with uploaded file content or live feed content, use that content as primary evidence. "
-        "If content isn't provided, produce a concise general report."
+        "If content isn't provided, produce a concise general report.\n\n"
+        "Instructions:\n"
+        "- Compose a report ~ 400-800 words depending on complexity.\n"
+        "- Use inline citation markers like [1], [2] where you reference the provided content.\n"
+        "- At the end, include a \"Sources:\" section listing sources in the format:\n"
+        "  [1] source description (e.g., 'myfile.pdf p.12' or 'MockNews: article title (2025-09-20)')\n"
     )
 
     user_prompt = f"""Question: {question}
@@ -178,63 +319,232 @@ Uploaded file content (if any):
 
 Live feed content (if any):
 {live_text or '[none]'}
-
-Instructions:
-- Compose a report ~ 400-800 words depending on complexity.
-- Use inline citation markers like [1], [2] where you reference the provided content.
-- At the end, include a "Sources:" section listing sources in the format:
-  [1] source description (e.g., 'myfile.pdf p.12' or 'MockNews: article title (2025-09-20)')
 """
 
-    # Mock mode if client unavailable
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt}
+    ]
+
+def _mock_report(question: str, file_text: str, live_text: str):
+    """Build the mock report used when no LLM client is configured or the call fails."""
+    # Create a deterministic mock report that references any sources found
+    sources = []
+    idx = 1
+    if file_text and file_text.strip() != "":
+        sources.append(f"[{idx}] Uploaded Files combined (user files)")
+        idx += 1
+    if live_text and live_text.strip() != "":
+        sources.append(f"[{idx}] Live feed updates (ingested)")
+        idx += 1
+    if not sources:
+        sources = ["[1] General knowledge / no sources provided"]
+
+    # Build mock report
+    report_lines = []
+    report_lines.append(f"# Research Report: {question}\n")
+    report_lines.append("## Key Takeaways")
+    report_lines.append("- This is a mock key takeaway generated for demo purposes.")
+    report_lines.append("- The assistant will use uploaded files and live feed when available.")
+    report_lines.append("\n## Abstract")
+    report_lines.append("This mock report demonstrates the Smart Research Assistant functionality.")
+    report_lines.append("\n## Introduction")
+    report_lines.append("The system ingests documents and live feeds, then synthesizes answers with citations.")
+    report_lines.append("\n## Detailed Findings")
+    report_lines.append("Detailed analysis would come from the LLM in production. Example reference: [1].")
+    report_lines.append("\n## Conclusion")
+    report_lines.append("Mock conclusion.")
+    report_lines.append("\n## Sources:")
+    report_lines.extend(sources)
+    return "\n\n".join(report_lines)
+
+def _create_completion(client, question: str, file_text: str, live_text: str):
+    """
+    Create the streamed chat completion, retrying rate-limit/connection errors with backoff.
+    Gives up after LLM_MAX_ATTEMPTS and re-raises; other errors are raised immediately.
+    """
+    from openai import APIConnectionError, RateLimitError
+    for attempt in range(LLM_MAX_ATTEMPTS):
+        try:
+            return client.chat.completions.create(
+                model=MODEL_NAME,
+                messages=_report_messages(question, file_text, live_text),
+                temperature=0.1,
+                max_tokens=1500,
+                stream=True
+            )
+        except (RateLimitError, APIConnectionError):
+            if attempt == LLM_MAX_ATTEMPTS - 1:
+                raise
+            time.sleep(LLM_RETRY_BACKOFF * 2 ** attempt)
+
+def stream_llm_generate(question: str, file_text: str, live_text: str, status: dict = None):
+    """
+    Stream the structured report from the LLM.
+    Yields text chunks of at least STREAM_MIN_CHARS so Streamlit isn't redrawn per token.
+    If client not configured, yields the mock report in one piece.
+    If status is given, status["ok"] is left False when the call failed or returned no text.
+    """
+    if status is None:
+        status = {}
+    status["ok"] = False
+    client = get_client()
     if client is None:
-        # Create a deterministic mock report that references any sources found
-        sources = []
-        idx = 1
-        if file_text and file_text.strip() != "":
-            sources.append(f"[{idx}] Uploaded Files combined (user files)")
-            idx += 1
-        if live_text and live_text.strip() != "":
-            sources.append(f"[{idx}] Live feed updates (ingested)")
-            idx += 1
-        if not sources:
-            sources = ["[1] General knowledge / no sources provided"]
-
-        # Build mock report
-        report_lines = []
-        report_lines.append(f"# Research Report: {question}\n")
-        report_lines.append("## Key Takeaways")
-        report_lines.append("- This is a mock key takeaway generated for demo purposes.")
-        report_lines.append("- The assistant will use uploaded files and live feed when available.")
-        report_lines.append("\n## Abstract")
-        report_lines.append("This mock report demonstrates the Smart Research Assistant functionality.")
-        report_lines.append("\n## Introduction")
-        report_lines.append("The system ingests documents and live feeds, then synthesizes answers with citations.")
-        report_lines.append("\n## Detailed Findings")
-        report_lines.append("Detailed analysis would come from the LLM in production. Example reference: [1].")
-        report_lines.append("\n## Conclusion")
-        report_lines.append("Mock conclusion.")
-        report_lines.append("\n## Sources:")
-        report_lines.extend(sources)
-        return "\n\n".join(report_lines)
-
-    # Real LLM call
+        status["ok"] = True
+        yield _mock_report(question, file_text, live_text)
+        return
+
     try:
-        response = client.chat.completions.create(
-            model=MODEL_NAME,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            temperature=0.1,
-            max_tokens=1500
-        )
-        # The returned structure depends on the client lib; adapt if necessary
-        report_text = response.choices[0].message.content
-        return report_text
+        response = _create_completion(client, question, file_text, live_text)
     except Exception as e:
-        # fallback message
-        return f"(LLM error: {e})\n\n" + call_llm_generate(question, file_text, live_text)  # try mock
+        yield f"(LLM error: {e})\n\n" + _mock_report(question, file_text, live_text)
+        return
+
+    # a failure mid-stream can't be retried without repeating text, so just note it
+    streamed = False
+    try:
+        pending = []
+        pending_len = 0
+        for chunk in response:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                pending.append(delta)
+                pending_len += len(delta)
+                if pending_len >= STREAM_MIN_CHARS:
+                    streamed = True
+                    yield "".join(pending)
+                    pending = []
+                    pending_len = 0
+        if pending:
+            streamed = True
+            yield "".join(pending)
+    except Exception as e:
+        yield f"\n\n(LLM error: {e})"
+        return
+    if not streamed:
+        yield "(LLM error: the model returned an empty response)\n\n" + _mock_report(question, file_text, live_text)
+        return
+    status["ok"] = True
+
+def _text_hash(text: str) -> str:
+    """Short content hash used as a cache key for large prompt inputs."""
+    return hashlib.blake2b((text or "").encode("utf-8"), digest_size=16).hexdigest()
+
+@st.cache_resource(show_spinner=False)
+def _report_cache():
+    """
+    Process-wide store of generated reports shared by all sessions, as (lock, entries).
+    entries is {(question, file_hash, live_hash): (created_at, report)} kept oldest-first.
+    """
+    return threading.Lock(), OrderedDict()
+
+def get_cached_report(key):
+    """Return a cached report for key, or None if missing or older than REPORT_CACHE_TTL."""
+    lock, cache = _report_cache()
+    with lock:
+        hit = cache.get(key)
+    if hit and time.time() - hit[0] < REPORT_CACHE_TTL:
+        return hit[1]
+    return None
+
+def put_cached_report(key, report_text):
+    lock, cache = _report_cache()
+    now = time.time()
+    with lock:
+        cache[key] = (now, report_text)
+        cache.move_to_end(key)
+        # oldest entries are at the front: drop expired ones, then trim to REPORT_CACHE_MAX
+        while cache:
+            oldest_key, (ts, _) = next(iter(cache.items()))
+            if now - ts < REPORT_CACHE_TTL and len(cache) <= REPORT_CACHE_MAX:
+                break
+            cache.pop(oldest_key)
+
+@st.cache_resource(show_spinner="Loading the question-similarity model (first use only)...")
+def get_embedder():
+    """
+    Load the sentence embedding model once per process.
+    Returns None if sentence-transformers isn't installed, which disables the semantic cache.
+    """
+    try:
+        from sentence_transformers import SentenceTransformer
+        return SentenceTransformer(EMBEDDING_MODEL)
+    except Exception:
+        return None
+
+def embed_questions(questions):
+    """Unit-normalized embeddings of the questions, or None if no embedder is available."""
+    embedder = get_embedder()
+    if embedder is None:
+        return None
+    return embedder.encode(list(questions), normalize_embeddings=True)
+
+def _question_terms(question: str):
+    """Content words of a question, ignoring case, order, stop words and plural 's'."""
+    words = (w for w in _WORD_RE.findall(question.lower()) if w not in SEMANTIC_STOP_WORDS)
+    return frozenset(w[:-1] if len(w) > 3 and w.endswith("s") else w for w in words)
+
+def get_semantic_report(question: str, file_hash: str, live_hash: str):
+    """
+    Return (original_question, report) for an earlier question that reads as the same question:
+    same files and live feed, same content words (so "advantages of X" never matches
+    "disadvantages of X"), and cosine similarity of at least SEMANTIC_CACHE_THRESHOLD.
+    Questions are embedded here, and only when such a candidate exists.
+    """
+    terms = _question_terms(question)
+    candidates = [
+        e for e in st.session_state.sem_cache
+        if e["file_hash"] == file_hash and e["live_hash"] == live_hash and e["terms"] == terms
+    ]
+    if not candidates:
+        return None
+    pending = [e for e in candidates if e["vec"] is None]
+    vecs = embed_questions([question] + [e["question"] for e in pending])
+    if vecs is None:
+        return None
+    q_vec = vecs[0]
+    for e, vec in zip(pending, vecs[1:]):
+        e["vec"] = vec  # embed each stored question once
+    best_score, best = 0.0, None
+    for e in candidates:
+        score = float(e["vec"] @ q_vec)  # vectors are normalized, so this is cosine similarity
+        if score > best_score:
+            best_score, best = score, (e["question"], e["report"])
+    return best if best_score >= SEMANTIC_CACHE_THRESHOLD else None
+
+def put_semantic_report(file_hash: str, live_hash: str, question: str, report_text: str):
+    """Remember a generated report; its question is embedded lazily by get_semantic_report."""
+    st.session_state.sem_cache.append(
+        {"file_hash": file_hash, "live_hash": live_hash, "question": question,
+         "terms": _question_terms(question), "vec": None, "report": report_text}
+    )
+
+# -------------------------
+# Report post-processing
+# -------------------------
+def _report_sections(report_text: str):
+    """Split a markdown report into {lowercased header (without trailing ':'): body} in one pass."""
+    sections = {}
+    matches = list(_SECTION_RE.finditer(report_text))
+    for i, m in enumerate(matches):
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(report_text)
+        name = m.group(1).rstrip(":").strip().lower()
+        sections.setdefault(name, report_text[m.end():end])
+    return sections
+
+def _parse_bullets(body: str, bullet_re=_BULLET_RE):
+    """Return the bullet lines ('-', '•' or '[n]' by default) of a section body, without the bullet marker."""
+    return [ln.strip("-• ").strip() for ln in bullet_re.findall(body)]
+
+def _key_takeaways(report_text: str, sections):
+    """Return the '-'/'•' bullets of the Key Takeaways section, whatever its heading looks like."""
+    body = sections.get("key takeaways")
+    if body is None:
+        m = _TAKEAWAYS_RE.search(report_text)
+        body = m.group(1) if m else ""
+    return _parse_bullets(body, _TAKEAWAY_BULLET_RE)
 
 # -------------------------
 # UI: Custom CSS (keeps your original theme)
@@ -338,7 +648,7 @@ with st.sidebar:
     st.markdown("---")
     st.subheader("Billing Log (mock Flexprice)")
     if st.session_state.billing_log:
-        for rec in st.session_state.billing_log[-10:][::-1]:
+        for rec in islice(reversed(st.session_state.billing_log), 10):
             st.markdown(f"- {rec['ts']}: \"{rec['question']}\" → {rec['cost']} credit(s)")
     else:
         st.markdown("No billing activity yet.")
@@ -351,9 +661,11 @@ if generate_clicked:
         st.error("❌ Please enter a research question.")
     else:
         # Extract file content (if files)
-        file_text, file_sources = extract_file_content(uploaded_files) if uploaded_files else ("", [])
+        file_text, file_sources, file_hash, skipped_files = prepare_file_context(uploaded_files)
+        if skipped_files:
+            st.warning("⚠ Context limit reached; these files were left out of the report: " + ", ".join(skipped_files))
         # Compose live feed combined text
-        live_text = "\n\n".join([f"{e['title']} ({e['source']}):\n{e['content']}" for e in st.session_state.live_feed])
+        live_text = _live_feed_text(st.session_state.live_feed)
 
         # prepare sources list for sidebar display and for mapping citations
         combined_sources = []
@@ -367,39 +679,54 @@ if generate_clicked:
         with st.spinner("🔎 Fetching sources and preparing context..."):
             time.sleep(0.6)
 
-        # Call the LLM (or mock)
-        with st.spinner("✍️ Summarizing and generating the report (this may take a few seconds)..."):
-            report_text = call_llm_generate(question.strip(), file_text, live_text)
-            # small delay for UX
-            time.sleep(0.5)
-
-        # Post-process: try to extract Sources section if present
-        extracted_sources = []
-        if "## Sources:" in report_text or "\n## Sources" in report_text or "\nSources:" in report_text:
-            # naive split to find sources - keep lines after "Sources"
-            lower = report_text.lower()
-            idx = lower.find("sources")
-            if idx != -1:
-                src_part = report_text[idx:]
-                lines = src_part.splitlines()
-                for ln in lines:
-                    ln = ln.strip()
-                    if ln.startswith("[") or ln.startswith("-") or ln.startswith("•"):
-                        # treat as bullet
-                        extracted_sources.append(ln.strip("-• ").strip())
-                # fallback: if none found, leave empty
+        # Reuse a cached report for identical inputs or a reworded question over the same
+        # context, otherwise stream it from the LLM (or mock)
+        live_hash = _text_hash(live_text)
+        cache_key = (question.strip(), file_hash, live_hash)
+        report_text = get_cached_report(cache_key)
+        from_cache = report_text is not None
+        reused_from = question.strip() if from_cache else None  # question the reused report was written for
+        if report_text is None:
+            hit = get_semantic_report(question.strip(), file_hash, live_hash)
+            if hit:
+                from_cache = True
+                reused_from, report_text = hit
+        generation_failed = False
+        if report_text is None:
+            with st.spinner("✍️ Summarizing and generating the report (this may take a few seconds)..."):
+                stream_box = st.empty()
+                gen_status = {}
+                report_text = stream_box.write_stream(
+                    stream_llm_generate(question.strip(), file_text, live_text, status=gen_status))
+                stream_box.empty()
+            # don't pin (or bill) a failed or empty generation
+            generation_failed = not (gen_status.get("ok") and report_text)
+            if not generation_failed:
+                put_cached_report(cache_key, report_text)
+                put_semantic_report(file_hash, live_hash, question.strip(), report_text)
+
+        # Post-process: split the report into sections once and pull out Sources
+        sections = _report_sections(report_text)
+        sources_body = sections.get("sources")
+        if sources_body is None:
+            # LLMs often emit a plain "Sources:" line instead of a header
+            m = _SOURCES_RE.search(report_text)
+            sources_body = m.group(1) if m else ""
+        extracted_sources = _parse_bullets(sources_body)
         # fallback: map our combined_sources if no explicit sources found
         if not extracted_sources and combined_sources:
             extracted_sources = [f"[{s['id']}] {s['desc']}" for s in combined_sources]
 
-        # Update session state counters and billing
+        # Update session state counters and billing (a report served from cache makes no LLM call,
+        # and a failed generation produced no report, so neither is charged)
+        cost = 0.0 if from_cache or generation_failed else COST_PER_REPORT
         st.session_state.questions += 1
         st.session_state.reports += 1
-        st.session_state.credits_used += COST_PER_REPORT
-        st.session_state.credits_remaining = max(0.0, st.session_state.credits_remaining - COST_PER_REPORT)
+        st.session_state.credits_used += cost
+        st.session_state.credits_remaining = max(0.0, st.session_state.credits_remaining - cost)
         st.session_state.billing_log.append({
             "question": question.strip(),
-            "cost": COST_PER_REPORT,
+            "cost": cost,
             "ts": time.strftime("%Y-%m-%d %H:%M:%S")
         })
 
@@ -417,23 +744,11 @@ if generate_clicked:
 
         # Display the report in the main area
         st.markdown("### 📑 Final Report")
+        if from_cache:
+            st.info(f"♻️ Reused the cached report for \"{reused_from}\" (same files and live feed). "
+                    "No credits were charged.")
         # Use an info box for Key Takeaways if we can extract them
-        # Try to find "Key Takeaways" section
-        key_takeaways = []
-        if "Key Takeaways" in report_text:
-            try:
-                # naive extraction: split between "Key Takeaways" and next "##"
-                start = report_text.find("Key Takeaways")
-                tail = report_text[start:]
-                # look for next section header
-                next_sec_idx = tail.find("\n\n")
-                # parse paragraph lines
-                lines = tail.splitlines()
-                for ln in lines[1:8]:
-                    if ln.strip().startswith("-") or ln.strip().startswith("•"):
-                        key_takeaways.append(ln.strip("-• ").strip())
-            except Exception:
-                key_takeaways = []
+        key_takeaways = _key_takeaways(report_text, sections)
 
         if key_takeaways:
             st.markdown("<div class='report-box'><b>🔎 Key Takeaways</b></div>", unsafe_allow_html=True)